@@ -0,0 +1,221 @@
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TRACEMALLOC_FRAMES = 25
+TOP_STATS = 40
+
+
+def profiled_phase(name):
+    """Runs the decorated APIManager method inside the named phase of self._profiler, if profiling is on."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._profiler is None:
+                return method(self, *args, **kwargs)
+            with self._profiler.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RunProfiler:
+    """Collects cProfile stats and tracemalloc allocation diffs per phase of a single run.
+
+    Only one cProfile profiler can be active at a time, so entering a nested phase pauses the outer one. A phase entered
+    while the same phase is open on the same thread or on the main thread (worker calls of a main thread phase) is
+    accounted by the outer call only. Phases entered from worker threads are timed but not profiled. tracemalloc hooks
+    every allocation and inflates cProfile times, capture cpu and memory in separate runs for exact CPU numbers.
+    Results are written to output_dir when the process exits.
+    """
+
+    def __init__(self, run_name, output_dir=None, cpu=True, memory=True):
+        if output_dir is None:
+            output_dir = F'profile_{run_name}_{time.strftime("%Y%m%d_%H%M%S")}'
+        self.output_dir = output_dir
+        self._cpu = cpu
+        self._memory = memory
+        self._main_thread = threading.get_ident()
+        self._lock = threading.Lock()
+        self._thread_phases = threading.local()
+        self._main_phases = set()
+        self._phase_stack = []
+        self._profiles = {}
+        self._alloc_diffs = {}
+        self._phases = {}
+        self._written = False
+        if memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        atexit.register(self.write)
+
+    @staticmethod
+    def from_option(run_name, profile):
+        """RunProfiler for the --profile option: True captures both, 'cpu' or 'memory' only one of them."""
+        if not profile:
+            return None
+        if profile not in (True, 'cpu', 'memory'):
+            print(F'UNKNOWN PROFILE OPTION {profile}, USE --profile, --profile=cpu OR --profile=memory')
+            sys.exit(-1)
+        return RunProfiler(run_name=run_name, cpu=profile in (True, 'cpu'), memory=profile in (True, 'memory'))
+
+    @contextmanager
+    def phase(self, name):
+        on_main_thread = threading.get_ident() == self._main_thread
+        thread_phases = self._thread_phases.__dict__.setdefault('names', set())
+        with self._lock:
+            # already inside this phase (add_department_group -> update_user_data, or a worker of
+            # delete_user_ids -> post_bulk_delete), it is accounted by the outer call
+            nested = name in thread_phases or name in self._main_phases
+            if not nested and on_main_thread:
+                self._main_phases.add(name)
+        if nested:
+            yield
+            return
+        thread_phases.add(name)
+        profiled = self._cpu and on_main_thread
+        if profiled and self._phase_stack:
+            self._profiles[self._phase_stack[-1]].disable()
+        # snapshots are taken outside of the cProfile windows
+        start_snapshot = tracemalloc.take_snapshot() if self._memory and on_main_thread else None
+        if profiled:
+            self._phase_stack.append(name)
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            if profiled:
+                profile.disable()
+                self._phase_stack.pop()
+            if start_snapshot is not None:
+                self._add_alloc_diff(name=name, start_snapshot=start_snapshot, end_snapshot=tracemalloc.take_snapshot())
+            if profiled and self._phase_stack:
+                self._profiles[self._phase_stack[-1]].enable()
+            thread_phases.discard(name)
+            with self._lock:
+                if on_main_thread:
+                    self._main_phases.discard(name)
+                phase_stats = self._phases.setdefault(name, {'calls': 0, 'wall_time': 0.0})
+                phase_stats['calls'] += 1
+                phase_stats['wall_time'] += wall_time
+
+    @staticmethod
+    def _own_allocation(traceback):
+        # allocations of tracemalloc and of this module are left out, checked per statistic since
+        # Snapshot.filter_traces is much slower on large heaps
+        return traceback[-1].filename in (tracemalloc.__file__, __file__)
+
+    def _add_alloc_diff(self, name, start_snapshot, end_snapshot):
+        """Adds what this call of the phase allocated (and did not free) to the phase's totals."""
+        phase_diffs = self._alloc_diffs.setdefault(name, {})
+        for stat in end_snapshot.compare_to(start_snapshot, 'traceback'):
+            if (stat.size_diff == 0 and stat.count_diff == 0) or RunProfiler._own_allocation(stat.traceback):
+                continue
+            size_diff, count_diff = phase_diffs.get(stat.traceback, (0, 0))
+            phase_diffs[stat.traceback] = (size_diff + stat.size_diff, count_diff + stat.count_diff)
+
+    def _path(self, file_name):
+        return os.path.join(self.output_dir, file_name)
+
+    def write(self):
+        atexit.unregister(self.write)
+        if self._written:
+            return
+        self._written = True
+        os.makedirs(self.output_dir, exist_ok=True)
+        run_end_snapshot = None
+        if self._memory:
+            run_end_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        for name, profile in self._profiles.items():
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:
+                # phase was entered but no calls were recorded
+                continue
+            stats.dump_stats(self._path(F'{name}.prof'))
+            with open(self._path(F'{name}.txt'), 'w') as stats_f:
+                pstats.Stats(profile, stream=stats_f).sort_stats('cumulative').print_stats(TOP_STATS)
+            with open(self._path(F'{name}.folded'), 'w') as folded_f:
+                for stack, value in RunProfiler.folded_cpu_stacks(stats):
+                    folded_f.write(F'{stack} {value}\n')
+        for name, phase_diffs in self._alloc_diffs.items():
+            # per line totals are summed from the tracebacks by their most recent frame
+            line_diffs = {}
+            for traceback, (size_diff, count_diff) in phase_diffs.items():
+                frame = traceback[-1]
+                line_size_diff, line_count_diff = line_diffs.get((frame.filename, frame.lineno), (0, 0))
+                line_diffs[(frame.filename, frame.lineno)] = (line_size_diff + size_diff, line_count_diff + count_diff)
+            top_lines = sorted(line_diffs.items(), key=lambda diff: diff[1][0], reverse=True)
+            with open(self._path(F'{name}.alloc.txt'), 'w') as alloc_f:
+                for (file_name, line_no), (size_diff, count_diff) in top_lines[:TOP_STATS]:
+                    alloc_f.write(F'{file_name}:{line_no}: size_diff={size_diff:+} B, count_diff={count_diff:+}\n')
+            with open(self._path(F'{name}.alloc.folded'), 'w') as folded_f:
+                for traceback, (size_diff, _) in phase_diffs.items():
+                    # flame graphs take positive weights only, frees are left out
+                    if size_diff > 0:
+                        folded_f.write(F'{RunProfiler.folded_alloc_stack(traceback)} {size_diff}\n')
+        if run_end_snapshot is not None:
+            with open(self._path('run_end.alloc.txt'), 'w') as alloc_f:
+                line_stats = [stat for stat in run_end_snapshot.statistics('lineno')
+                              if not RunProfiler._own_allocation(stat.traceback)]
+                for stat in line_stats[:TOP_STATS]:
+                    alloc_f.write(F'{stat}\n')
+            with open(self._path('run_end.alloc.folded'), 'w') as folded_f:
+                for stat in run_end_snapshot.statistics('traceback'):
+                    if RunProfiler._own_allocation(stat.traceback):
+                        continue
+                    folded_f.write(F'{RunProfiler.folded_alloc_stack(stat.traceback)} {stat.size}\n')
+        with open(self._path('phases.json'), 'w') as phases_f:
+            json.dump({'cpu': self._cpu, 'memory': self._memory, 'phases': self._phases}, phases_f, indent=4)
+        print(F'PROFILE WRITTEN TO {self.output_dir}')
+
+    @staticmethod
+    def folded_alloc_stack(traceback):
+        return ';'.join(F'{os.path.basename(frame.filename)}:{frame.lineno}' for frame in traceback)
+
+    @staticmethod
+    def folded_cpu_stacks(stats):
+        """Collapsed stacks in microseconds rebuilt from cProfile caller/callee pairs.
+
+        cProfile keeps no full stacks, so a function's time is split between its callers in proportion
+        to the cumulative time of each call edge.
+        """
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.stats.items():
+            for caller, (_, _, _, edge_cumulative) in callers.items():
+                callees.setdefault(caller, []).append((func, edge_cumulative))
+        roots = [func for func, func_stats in stats.stats.items() if not func_stats[4]]
+
+        def label(func):
+            file_name, line_no, func_name = func
+            return F'{func_name} ({os.path.basename(file_name)}:{line_no})'
+
+        folded = []
+        stack = [(func, (label(func),), 1.0) for func in roots]
+        while stack:
+            func, path, scale = stack.pop()
+            _, _, total_time, cumulative_time, _ = stats.stats[func]
+            self_time = int(total_time * scale * 1000000)
+            if self_time > 0:
+                folded.append((';'.join(path), self_time))
+            if cumulative_time <= 0:
+                continue
+            for callee, edge_cumulative in callees.get(func, []):
+                callee_label = label(callee)
+                callee_cumulative = stats.stats[callee][3]
+                # skip recursion and edges below a microsecond
+                if callee_label in path or callee_cumulative <= 0 or scale * edge_cumulative < 0.000001:
+                    continue
+                stack.append((callee, path + (callee_label,), scale * edge_cumulative / callee_cumulative))
+        return folded
@@ -0,0 +1,87 @@
+import json
+import linecache
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiling import profiled_phase, RunProfiler  # noqa: E402
+
+
+class Manager:
+    def __init__(self, profiler):
+        self._profiler = profiler
+
+    @profiled_phase('updates')
+    def update_all(self, workers=0):
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda _: self.update_one(), range(3)))
+        else:
+            for _ in range(3):
+                self.update_one()
+
+    @profiled_phase('updates')
+    def update_one(self):
+        time.sleep(0.05)
+
+    @profiled_phase('reference_data')
+    def fetch_one(self):
+        time.sleep(0.05)
+
+    @profiled_phase('user_paging')
+    def allocate_page(self):
+        return [str(idx) * 10 for idx in range(2000)]
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    run_profiler = RunProfiler(run_name='test', output_dir=str(tmp_path / 'profile'))
+    yield run_profiler
+    # writes once and unregisters from atexit
+    run_profiler.write()
+
+
+def phases(run_profiler):
+    run_profiler.write()
+    with open(os.path.join(run_profiler.output_dir, 'phases.json')) as phases_f:
+        return json.load(phases_f)['phases']
+
+
+def test_reentered_phase_counted_once(profiler):
+    Manager(profiler).update_all()
+    updates = phases(profiler)['updates']
+    assert updates['calls'] == 1
+    assert updates['wall_time'] < 0.25
+
+
+def test_worker_calls_of_main_thread_phase_counted_once(profiler):
+    Manager(profiler).update_all(workers=3)
+    updates = phases(profiler)['updates']
+    assert updates['calls'] == 1
+    assert updates['wall_time'] < 0.15
+
+
+def test_worker_phases_without_main_thread_phase_are_counted(profiler):
+    manager = Manager(profiler)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(lambda _: manager.fetch_one(), range(3)))
+    assert phases(profiler)['reference_data']['calls'] == 3
+
+
+def test_alloc_files_hold_what_the_phase_allocated(profiler):
+    manager = Manager(profiler)
+    kept_before = [str(idx) * 10 for idx in range(2000)]  # noqa: F841
+    page = manager.allocate_page()  # noqa: F841
+    phases(profiler)
+    with open(os.path.join(profiler.output_dir, 'user_paging.alloc.txt')) as alloc_f:
+        file_name, line_no = alloc_f.readline().split(': ')[0].rsplit(':', 1)
+    # the top line is the page allocated inside the phase, not the list allocated before it
+    assert os.path.basename(file_name) == 'test_profiling.py'
+    assert linecache.getline(file_name, int(line_no)).strip().startswith('return [str(idx)')
+    with open(os.path.join(profiler.output_dir, 'user_paging.alloc.folded')) as folded_f:
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in folded_f)
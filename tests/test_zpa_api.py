@@ -0,0 +1,157 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zpa_api import APIManager, AppSegmentIndex, CsvWriter, JsonLinesWriter, TextWriter  # noqa: E402
+
+APP_SEGMENTS = [
+    {'id': '1', 'name': 'corp', 'segmentGroupName': 'g', 'domainNames': ['*.corp.com'],
+     'tcpPortRanges': ['80', '80', '443', '445']},
+    {'id': '2', 'name': 'intranet', 'segmentGroupName': 'g', 'domainNames': ['intranet.corp.com'],
+     'tcpPortRange': [{'from': '1', 'to': '65535'}]},
+    {'id': '3', 'name': 'dc', 'segmentGroupName': 'g', 'domainNames': ['10.0.0.0/8'],
+     'tcpPortRanges': ['22', '22']},
+    {'id': '4', 'name': 'dc-web', 'segmentGroupName': 'g', 'domainNames': ['10.1.2.0/24', '2001:db8::/32'],
+     'tcpPortRanges': ['443', '443'], 'udpPortRanges': ['53', '53']},
+]
+
+
+def names(segments):
+    return [segment['name'] for segment in segments]
+
+
+def test_exact_domain_before_wildcard():
+    index = AppSegmentIndex(app_segments=APP_SEGMENTS)
+    assert names(index.lookup('intranet.corp.com', 443)) == ['intranet', 'corp']
+    assert names(index.lookup('Intranet.Corp.com.', 8080)) == ['intranet']
+
+
+def test_wildcard_does_not_cover_its_own_domain():
+    index = AppSegmentIndex(app_segments=APP_SEGMENTS)
+    assert names(index.lookup('corp.com', 443)) == []
+    assert names(index.lookup('a.b.corp.com', 444)) == ['corp']
+    assert names(index.lookup('a.b.corp.com', 446)) == []
+
+
+def test_ip_longest_prefix_first():
+    index = AppSegmentIndex(app_segments=APP_SEGMENTS)
+    assert names(index.lookup('10.1.2.3')) == ['dc-web', 'dc']
+    assert names(index.lookup('10.1.2.3', 22)) == ['dc']
+    assert names(index.lookup('10.1.2.3', 53, proto='udp')) == ['dc-web']
+    assert names(index.lookup('2001:db8::1', 443)) == ['dc-web']
+    assert names(index.lookup('192.168.0.1')) == []
+
+
+def test_merged_ranges():
+    assert AppSegmentIndex.merged_ranges([(443, 445), (80, 80), (444, 500), (81, 90)]) == ([80, 443], [90, 500])
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index_file = str(tmp_path / 'index.pickle')
+    AppSegmentIndex(app_segments=APP_SEGMENTS).save(index_file)
+    index = AppSegmentIndex.load(index_file)
+    assert names(index.lookup('intranet.corp.com', 443)) == ['intranet', 'corp']
+    assert names(index.lookup('10.1.2.3')) == ['dc-web', 'dc']
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode('utf-8')
+
+
+class FakeSession:
+    def __init__(self, segments, page_size, fail_at_page=None):
+        self.segments = segments
+        self.page_size = page_size
+        self.fail_at_page = fail_at_page
+
+    def get(self, url, headers):
+        page_no = int(url.split('page=')[1].split('&')[0])
+        if page_no == self.fail_at_page:
+            return FakeResponse(500, {'id': 'internal.server.error'})
+        total_pages = (len(self.segments) + self.page_size - 1) // self.page_size
+        page = self.segments[(page_no - 1) * self.page_size:page_no * self.page_size]
+        return FakeResponse(200, {'list': page, 'totalPages': str(total_pages)})
+
+
+def segment(seg_id, name, ports=('443', '443')):
+    return {'id': seg_id, 'name': name, 'segmentGroupName': 'g', 'domainNames': [F'{name}.corp.com'],
+            'tcpPortRanges': list(ports)}
+
+
+@pytest.fixture
+def exporter(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # drop the one request per two seconds limit
+    monkeypatch.setattr(APIManager, 'get_data_list', APIManager.get_data_list.__wrapped__.__wrapped__.__wrapped__)
+    api_manager = APIManager(ti='tenant', page_size=2)
+
+    def export(segments, fail_at_page=None, **kwargs):
+        def authenticated_session():
+            api_manager._session = FakeSession(segments=segments, page_size=2, fail_at_page=fail_at_page)
+        monkeypatch.setattr(api_manager, 'authenticated_session', authenticated_session)
+        api_manager.export_app_segments(**kwargs)
+    return export
+
+
+def read_jsonl(file_name):
+    with open(file_name) as export_f:
+        return [json.loads(line) for line in export_f]
+
+
+def test_export_changes_against_previous_snapshot(exporter):
+    exporter([segment('1', 'a'), segment('2', 'b'), segment('3', 'c')], output_file='full.jsonl')
+    assert [record['id'] for record in read_jsonl('full.jsonl')] == ['1', '2', '3']
+
+    exporter([segment('1', 'a'), segment('2', 'b', ports=('80', '80')), segment('4', 'd')],
+             output_file='changes.jsonl', changes_only=True)
+    changes = {record['id']: record['change'] for record in read_jsonl('changes.jsonl')}
+    assert changes == {'2': 'changed', '4': 'added', '3': 'removed'}
+
+    exporter([segment('1', 'a'), segment('2', 'b', ports=('80', '80')), segment('4', 'd')],
+             output_file='no_changes.jsonl', changes_only=True)
+    assert read_jsonl('no_changes.jsonl') == []
+
+
+def test_snapshot_kept_when_export_fails(exporter):
+    exporter([segment('1', 'a'), segment('2', 'b'), segment('3', 'c')], output_file='full.jsonl')
+    with open('app_segments_snapshot_tenant.json') as snapshot_f:
+        snapshot = snapshot_f.read()
+    with pytest.raises(SystemExit):
+        exporter([segment('1', 'a', ports=('80', '80')), segment('2', 'b'), segment('3', 'c')],
+                 fail_at_page=2, output_file='failed.jsonl', changes_only=True)
+    with open('app_segments_snapshot_tenant.json') as snapshot_f:
+        assert snapshot_f.read() == snapshot
+    assert not os.path.exists('app_segments_snapshot_tenant.json.tmp')
+
+
+def write_records(writer_class):
+    export_file = io.StringIO()
+    writer = writer_class(export_file)
+    writer.write(segment('1', 'a', ports=('80', '80', '443', '445')))
+    writer.write({'id': '2', 'name': 'b', 'segmentGroupName': 'g'}, change='removed')
+    return export_file.getvalue()
+
+
+def test_csv_writer():
+    assert write_records(CsvWriter).splitlines() == [
+        'change,id,name,segmentGroupName,domainNames,tcpPortRanges,udpPortRanges',
+        ',1,a,g,a.corp.com,80-80 443-445,',
+        'removed,2,b,g,,,']
+
+
+def test_json_lines_writer():
+    lines = write_records(JsonLinesWriter).splitlines()
+    assert json.loads(lines[0]) == segment('1', 'a', ports=('80', '80', '443', '445'))
+    assert json.loads(lines[1]) == {'id': '2', 'name': 'b', 'segmentGroupName': 'g', 'change': 'removed'}
+
+
+def test_text_writer():
+    assert write_records(TextWriter).splitlines() == ['a (g)', 'TCP PORT RANGES: 80-80,443-445', 'a.corp.com',
+                                                      'REMOVED: b (g)']
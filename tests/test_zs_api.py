@@ -0,0 +1,226 @@
+import json
+import os
+import sys
+
+import pytest
+import requests
+from ratelimit import sleep_and_retry
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zs_api import APIManager, chunks_of_iter, UsersScanError  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeSession:
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.urls = []
+
+    def get(self, url, headers):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(APIManager, 'BULK_DELETE_CHUNK_LEN', 2)
+    api_manager = APIManager(u='admin', p='password', k='0123456789abcdef')
+    api_manager._session = FakeSession()
+    return api_manager
+
+
+def test_chunks_of_iter_fills_chunks_from_a_generator():
+    assert list(chunks_of_iter((i for i in range(5)), chunk_len=2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_chunks_of_iter_empty_and_exact():
+    assert list(chunks_of_iter([], chunk_len=2)) == []
+    assert list(chunks_of_iter([1, 2, 3, 4], chunk_len=2)) == [[1, 2], [3, 4]]
+
+
+def test_confirm_bulk_delete_all_deleted():
+    result = FakeResponse(200, json.dumps({'ids': [1, 2]}).encode('utf-8'))
+    assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2], blk_del_result=result) == []
+
+
+def test_confirm_bulk_delete_reports_missing_ids():
+    result = FakeResponse(200, json.dumps({'ids': [1]}).encode('utf-8'))
+    assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2, 3], blk_del_result=result) == [2, 3]
+
+
+def test_confirm_bulk_delete_empty_body_is_confirmed():
+    assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2], blk_del_result=FakeResponse(204)) == []
+
+
+def test_confirm_bulk_delete_error_code_returns_chunk():
+    result = FakeResponse(400, b'{"code": "INVALID_INPUT_ARGUMENT"}')
+    assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2], blk_del_result=result) == [1, 2]
+
+
+def test_confirm_bulk_delete_unexpected_json_returns_chunk():
+    for body in ({'deleted': [1, 2]}, [1, 2], {'ids': None}):
+        result = FakeResponse(200, json.dumps(body).encode('utf-8'))
+        assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2], blk_del_result=result) == [1, 2]
+
+
+def test_confirm_bulk_delete_non_json_body_returns_chunk():
+    result = FakeResponse(200, b'<html>gateway</html>')
+    assert APIManager.confirm_bulk_delete(ids_chunk=[1, 2], blk_del_result=result) == [1, 2]
+
+
+def test_delete_users_chunk_survives_bad_response(manager, monkeypatch):
+    monkeypatch.setattr(manager, 'post_bulk_delete', lambda ids_chunk: FakeResponse(200, b'\xff not json'))
+    assert manager.delete_users_chunk([1, 2]) == [1, 2]
+
+
+def test_delete_user_ids_rescans_until_shifted_pages_are_deleted(manager, monkeypatch):
+    users = list(range(1, 8))
+    page_size = 2
+
+    def paged_ids():
+        # every page is read from the current list, so deletes in between shift the later pages
+        page_no = 0
+        while True:
+            page = users[page_no * page_size:(page_no + 1) * page_size]
+            if not page:
+                return
+            for user_id in page:
+                yield user_id
+            page_no += 1
+
+    def delete_chunk(ids_chunk):
+        for user_id in ids_chunk:
+            users.remove(user_id)
+        return []
+
+    monkeypatch.setattr(manager, 'delete_users_chunk', delete_chunk)
+    assert manager.delete_user_ids(user_ids=paged_ids(), rescan=paged_ids) == []
+    assert users == []
+
+
+def test_delete_user_ids_reports_not_deleted_and_terminates(manager, monkeypatch):
+    users = [1, 2, 3]
+    monkeypatch.setattr(manager, 'delete_users_chunk', lambda ids_chunk: list(ids_chunk))
+    assert sorted(manager.delete_user_ids(user_ids=iter(users), rescan=lambda: iter(users))) == [1, 2, 3]
+
+
+def test_delete_user_ids_without_rescan_makes_one_pass(manager, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(manager, 'delete_users_chunk', lambda ids_chunk: deleted.extend(ids_chunk) or [])
+    assert manager.delete_user_ids(user_ids=[5, 6, 7]) == []
+    assert deleted == [5, 6, 7]
+
+
+def test_iter_user_ids_drops_partial_department_and_group_matches(manager, monkeypatch):
+    users = [{'id': 1, 'name': 'a', 'department': {'name': 'Sales'}, 'groups': [{'name': 'g1'}]},
+             {'id': 2, 'name': 'b', 'department': {'name': 'Sales Ops'}, 'groups': [{'name': 'g1'}]},
+             {'id': 3, 'name': 'c', 'department': {'name': 'Sales'}, 'groups': [{'name': 'g10'}]},
+             {'id': 4, 'name': 'd', 'department': None, 'groups': None}]
+    monkeypatch.setattr(manager, 'iter_users', lambda department=None, group=None: iter(users))
+    assert list(manager.iter_user_ids(department='Sales')) == [1, 3]
+    assert list(manager.iter_user_ids(group='g1')) == [1, 2]
+    assert list(manager.iter_user_ids(department='Sales', group='g1')) == [1]
+
+
+@pytest.fixture
+def unlimited_users_pages(monkeypatch):
+    # keep the 429 retry but drop the one page per six seconds limit
+    get_users_page = APIManager.get_users_page_to_modify.__wrapped__.__wrapped__.__wrapped__
+    monkeypatch.setattr(APIManager, 'get_users_page_to_modify', sleep_and_retry(get_users_page))
+
+
+def users_page(user_ids):
+    return FakeResponse(200, json.dumps([{'id': user_id, 'name': F'u{user_id}'} for user_id in user_ids]).encode())
+
+
+def test_iter_users_retries_after_quota_exceeded(manager, unlimited_users_pages):
+    manager._session = FakeSession([FakeResponse(429, b'{"code": "RATE_LIMIT_EXCEEDED"}', {'Retry-After': '0'}),
+                                    users_page([1, 2]),
+                                    users_page([])])
+    assert list(manager.iter_user_ids()) == [1, 2]
+    assert len(manager._session.urls) == 3
+
+
+def test_iter_users_stops_on_error_page(manager, unlimited_users_pages):
+    manager._session = FakeSession([users_page([1, 2]), FakeResponse(500, b'{"code": "UNEXPECTED_ERROR"}')])
+    user_ids = manager.iter_user_ids()
+    assert [next(user_ids), next(user_ids)] == [1, 2]
+    with pytest.raises(UsersScanError):
+        next(user_ids)
+
+
+def test_delete_user_ids_reports_queued_chunks_when_scan_fails(manager, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(manager, 'delete_users_chunk', lambda ids_chunk: deleted.extend(ids_chunk) or [ids_chunk[0]])
+
+    def failing_scan():
+        yield 1
+        yield 2
+        yield 3
+        raise UsersScanError('could not get users page 2')
+
+    assert manager.delete_user_ids(user_ids=failing_scan(), rescan=failing_scan) == [1]
+    assert deleted == [1, 2]
+
+
+class RaisingSession(FakeSession):
+    def get(self, url, headers):
+        raise requests.ConnectionError('connection reset')
+
+
+def test_desired_settings_later_patterns_override_earlier():
+    patterns = {'*': {'ipsControl': True, 'authRequired': False},
+                'branch-*': {'authRequired': True},
+                'branch-7': {'ipsControl': False}}
+    assert APIManager.desired_settings(name='hq', patterns=patterns) == {'ipsControl': True, 'authRequired': False}
+    assert APIManager.desired_settings(name='branch-1', patterns=patterns) == {'ipsControl': True, 'authRequired': True}
+    assert APIManager.desired_settings(name='branch-7', patterns=patterns) == {'ipsControl': False, 'authRequired': True}
+
+
+def test_desired_settings_matches_sublocation_paths():
+    patterns = {'*': {'ipsControl': True}, 'hq/*': {'authRequired': True}, '*/guest': {'sslScanEnabled': False}}
+    assert APIManager.desired_settings(name='hq/guest', patterns=patterns) == {'ipsControl': True,
+                                                                               'authRequired': True,
+                                                                               'sslScanEnabled': False}
+    assert APIManager.desired_settings(name='branch/staff', patterns=patterns) == {'ipsControl': True}
+    assert APIManager.desired_settings(name='hq-2/staff', patterns={'hq/*': {'authRequired': True}}) == {}
+
+
+def test_location_update_missing_boolean_is_false():
+    location = {'id': 1, 'name': 'hq'}
+    assert APIManager.location_update(location=location, settings={'ipsControl': False}) == []
+    assert APIManager.location_update(location=location, settings={'ipsControl': True}) == \
+        [('hq', {'id': 1, 'name': 'hq', 'ipsControl': True})]
+
+
+def test_location_update_returns_only_differing_objects():
+    location = {'id': 1, 'name': 'hq', 'ipsControl': True, 'upBandwidth': 100}
+    assert APIManager.location_update(location=location, settings={'ipsControl': True, 'upBandwidth': 100}) == []
+    updates = APIManager.location_update(location=location, settings={'ipsControl': True, 'upBandwidth': 200},
+                                         display_name='hq/guest')
+    assert updates == [('hq/guest', {'id': 1, 'name': 'hq', 'ipsControl': True, 'upBandwidth': 200})]
+    assert location['upBandwidth'] == 100
+
+
+def test_get_sublocations_failures_return_none(manager):
+    location = {'id': 1, 'name': 'hq'}
+    get_sublocations = APIManager.get_sublocations.__wrapped__.__wrapped__.__wrapped__
+    manager._session = RaisingSession()
+    assert get_sublocations(manager, location) is None
+    manager._session = FakeSession([FakeResponse(200, b'<html>maintenance</html>'),
+                                    FakeResponse(500, b'{"code": "UNEXPECTED_ERROR"}'),
+                                    FakeResponse(200, b'{"code": "UNEXPECTED_ERROR"}')])
+    assert get_sublocations(manager, location) is None
+    assert get_sublocations(manager, location) is None
+    assert get_sublocations(manager, location) is None
+    assert manager._sublocations_map == {}
@@ -1,11 +1,237 @@
+import bisect
+import csv
+import hashlib
+import ipaddress
 import json
 import fire
+import os
+import pickle
+from profiling import profiled_phase, RunProfiler
+import random
 import requests
 import sys
+import time
 
 from ratelimit import limits, sleep_and_retry
 
 
+class AppSegmentIndex:
+    """Answers which app segments cover host:port.
+
+    Domains are kept in a trie keyed by reversed labels (com -> example -> www), a node's 'wildcard' list holds
+    segments defined as *.<node domain>. IP and CIDR domains are kept per address family and prefix length, keyed by
+    network address. Port ranges are kept per segment, merged and sorted, so a lookup only checks the ports of the
+    segments that matched the host.
+    """
+
+    PROTOCOLS = ('TCP', 'UDP')
+    # bump when the layout of the saved containers changes
+    FORMAT_VERSION = 1
+
+    def __init__(self, app_segments=()):
+        self.segments = []
+        self._domain_trie = AppSegmentIndex._trie_node()
+        self._networks = {4: {}, 6: {}}
+        self._port_ranges = {proto: [] for proto in AppSegmentIndex.PROTOCOLS}
+        for app_seg in app_segments:
+            seg_idx = len(self.segments)
+            self.segments.append({'id': app_seg.get('id'),
+                                  'name': app_seg.get('name'),
+                                  'segmentGroupName': app_seg.get('segmentGroupName')})
+            for domain in app_seg.get('domainNames') or []:
+                self._add_domain(domain=domain, seg_idx=seg_idx)
+            for proto in AppSegmentIndex.PROTOCOLS:
+                self._port_ranges[proto].append(
+                    AppSegmentIndex.merged_ranges(AppSegmentIndex.port_ranges(app_seg=app_seg, proto=proto)))
+        self._sort_networks()
+
+    @staticmethod
+    def _trie_node():
+        return {'labels': {}, 'exact': [], 'wildcard': []}
+
+    @staticmethod
+    def port_ranges(app_seg, proto):
+        # tcpPortRanges is a flat list of strings [from, to, from, to, ...], tcpPortRange a list of dicts
+        ranges_list = app_seg.get(F'{proto.lower()}PortRanges')
+        if ranges_list:
+            return [(int(ranges_list[idx]), int(ranges_list[idx + 1])) for idx in range(0, len(ranges_list) - 1, 2)]
+        return [(int(port_range['from']), int(port_range['to']))
+                for port_range in app_seg.get(F'{proto.lower()}PortRange') or []]
+
+    @staticmethod
+    def merged_ranges(ranges):
+        """Overlapping ranges merged into ([starts], [ends]) sorted by start, ready for bisecting."""
+        starts, ends = [], []
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    @staticmethod
+    def domain_labels(domain):
+        return domain.strip().lower().rstrip('.').split('.')[::-1]
+
+    def _add_domain(self, domain, seg_idx):
+        try:
+            network = ipaddress.ip_network(domain.strip(), strict=False)
+        except ValueError:
+            network = None
+        if network is not None:
+            by_address = self._networks[network.version].setdefault(network.prefixlen, {})
+            by_address.setdefault(int(network.network_address), []).append(seg_idx)
+            return
+        labels = AppSegmentIndex.domain_labels(domain)
+        wildcard = labels[-1] == '*'
+        if wildcard:
+            labels = labels[:-1]
+        node = self._domain_trie
+        for label in labels:
+            node = node['labels'].setdefault(label, AppSegmentIndex._trie_node())
+        node['wildcard' if wildcard else 'exact'].append(seg_idx)
+
+    def _sort_networks(self):
+        # longest prefix first, so matches come out most specific first
+        self._networks_by_prefix = {version: sorted(by_prefix.items(), reverse=True)
+                                    for version, by_prefix in self._networks.items()}
+
+    def host_matches(self, host):
+        """Segment indices matching host, most specific match first."""
+        host = host.strip()
+        address = None
+        # only try parsing hosts that can be an address, a failed parse costs more than the whole trie walk
+        if host[-1:].isdigit() or ':' in host:
+            try:
+                address = ipaddress.ip_address(host)
+            except ValueError:
+                pass
+        if address is not None:
+            address_int = int(address)
+            max_prefix = address.max_prefixlen
+            matches = []
+            for prefixlen, by_address in self._networks_by_prefix[address.version]:
+                network_int = address_int >> (max_prefix - prefixlen) << (max_prefix - prefixlen)
+                matches.extend(by_address.get(network_int, ()))
+            return matches
+
+        labels = AppSegmentIndex.domain_labels(host)
+        wildcard_matches = []
+        node = self._domain_trie
+        for label in labels:
+            # *.example.com covers any host below example.com, not example.com itself
+            wildcard_matches.append(node['wildcard'])
+            node = node['labels'].get(label)
+            if node is None:
+                break
+        matches = list(node['exact']) if node is not None else []
+        for wildcard in reversed(wildcard_matches):
+            matches.extend(wildcard)
+        return matches
+
+    def covers_port(self, seg_idx, port, proto='TCP'):
+        starts, ends = self._port_ranges[proto][seg_idx]
+        range_idx = bisect.bisect_right(starts, port) - 1
+        return range_idx >= 0 and port <= ends[range_idx]
+
+    def lookup(self, host, port=None, proto='TCP'):
+        matches = self.host_matches(host)
+        if matches and port is not None:
+            proto = proto.upper()
+            port = int(port)
+            matches = [seg_idx for seg_idx in matches if self.covers_port(seg_idx=seg_idx, port=port, proto=proto)]
+        seen = set()
+        return [self.segments[seg_idx] for seg_idx in matches if not (seg_idx in seen or seen.add(seg_idx))]
+
+    def save(self, index_file):
+        # plain containers only, a pickled instance would be bound to the module it was built in (__main__ from the CLI)
+        index_data = {'format_version': AppSegmentIndex.FORMAT_VERSION,
+                      'segments': self.segments,
+                      'domain_trie': self._domain_trie,
+                      'networks': self._networks,
+                      'port_ranges': self._port_ranges}
+        with open(index_file, 'wb') as index_f:
+            pickle.dump(index_data, index_f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(index_file):
+        with open(index_file, 'rb') as index_f:
+            index_data = pickle.load(index_f)
+        if not isinstance(index_data, dict) or index_data.get('format_version') != AppSegmentIndex.FORMAT_VERSION:
+            raise ValueError(F'{index_file} is not an app segment index of format version '
+                             F'{AppSegmentIndex.FORMAT_VERSION}, rebuild it with build_app_segment_index')
+        index = AppSegmentIndex()
+        index.segments = index_data['segments']
+        index._domain_trie = index_data['domain_trie']
+        index._networks = index_data['networks']
+        index._port_ranges = index_data['port_ranges']
+        index._sort_networks()
+        return index
+
+
+class JsonLinesWriter:
+    EXTENSION = 'jsonl'
+
+    def __init__(self, export_file):
+        self._export_file = export_file
+
+    def write(self, app_seg, change=None):
+        record = dict(app_seg, change=change) if change is not None else app_seg
+        self._export_file.write(json.dumps(record))
+        self._export_file.write('\n')
+
+
+class CsvWriter:
+    EXTENSION = 'csv'
+    COLUMNS = ['change', 'id', 'name', 'segmentGroupName', 'domainNames', 'tcpPortRanges', 'udpPortRanges']
+
+    def __init__(self, export_file):
+        self._writer = csv.writer(export_file)
+        self._writer.writerow(CsvWriter.COLUMNS)
+
+    def write(self, app_seg, change=None):
+        self._writer.writerow([change or '',
+                               app_seg.get('id'),
+                               app_seg.get('name'),
+                               app_seg.get('segmentGroupName'),
+                               ' '.join(app_seg.get('domainNames') or []),
+                               ' '.join(port_ranges_list(app_seg=app_seg, proto='TCP')),
+                               ' '.join(port_ranges_list(app_seg=app_seg, proto='UDP'))])
+
+
+class TextWriter:
+    EXTENSION = 'txt'
+
+    def __init__(self, export_file):
+        self._export_file = export_file
+
+    def write(self, app_seg, change=None):
+        if change is not None:
+            self._export_file.write(F'{change.upper()}: ')
+        self._export_file.write(F"{app_seg.get('name')} ({app_seg.get('segmentGroupName')})")
+        self._export_file.write('\n')
+        for proto in AppSegmentIndex.PROTOCOLS:
+            port_ranges = port_ranges_list(app_seg=app_seg, proto=proto)
+            if port_ranges:
+                self._export_file.write(F'{proto} PORT RANGES: {",".join(port_ranges)}')
+                self._export_file.write('\n')
+        for domain in app_seg.get('domainNames') or []:
+            self._export_file.write(domain)
+            self._export_file.write('\n')
+
+
+EXPORT_WRITERS = {writer.EXTENSION: writer for writer in (JsonLinesWriter, CsvWriter, TextWriter)}
+
+
+def port_ranges_list(app_seg, proto):
+    return [F'{start}-{end}' for start, end in AppSegmentIndex.port_ranges(app_seg=app_seg, proto=proto)]
+
+
+def app_segment_hash(app_seg):
+    return hashlib.sha256(json.dumps(app_seg, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 class APIManager:
     ZPA_APU_URL = 'https://config.private.zscaler.com/signin'
     AUTH_DATA = 'client_id={id}&client_secret={secret}'
@@ -18,7 +244,8 @@ class APIManager:
     PAGINATION = '?page={page_no}&pagesize={page_size}&search='
     APP_SEGMENTS_EP = 'https://config.private.zscaler.com/mgmtconfig/v1/admin/customers/{segment_id}/application'
 
-    def __init__(self, ci, ti, s, page_size=None):
+    def __init__(self, ci=None, ti=None, s=None, page_size=None, profile=False):
+        self._profiler = RunProfiler.from_option(run_name='zpa_api', profile=profile)
         self._session = None
         self._tenant_id = ti
         self._client_id = ci
@@ -30,6 +257,7 @@ class APIManager:
         self._app_segments_list = None
         self._app_segments_endpoint = APIManager.APP_SEGMENTS_EP.format(segment_id=self._tenant_id)
 
+    @profiled_phase('auth')
     def authenticated_session(self):
         self._session = requests.session()
         auth_data = APIManager.AUTH_DATA.format(id=self._client_id, secret=self._client_secret)
@@ -45,36 +273,193 @@ class APIManager:
             print(F'AUTHENTICATION FAILED. RESPONSE CODE: {auth_result.status_code}')
             sys.exit(-1)
 
-    def port_ranges_str(self, ports_list):
-        port_ranges = []
-        for idx, port in enumerate(ports_list):
-            if idx % 2 == 0:
-                port_ranges.append(F'{ports_list[idx]}-{ports_list[idx - 1]}')
-        return port_ranges
-
     def dump_app_segments(self):
+        self.export_app_segments(output_format=TextWriter.EXTENSION,
+                                 output_file=F'app_domians_dump_{self._tenant_id}.txt',
+                                 update_snapshot=False)
+
+    def snapshot_file_name(self, snapshot_file=None):
+        if snapshot_file is not None:
+            return snapshot_file
+        return F'app_segments_snapshot_{self._tenant_id}.json'
+
+    @profiled_phase('export')
+    def export_app_segments(self, output_format='jsonl', output_file=None, changes_only=False,
+                            snapshot_file=None, update_snapshot=True):
+        if output_format not in EXPORT_WRITERS:
+            print(F'UNKNOWN OUTPUT FORMAT {output_format}, USE ONE OF: {", ".join(EXPORT_WRITERS)}')
+            sys.exit(-1)
+        if output_file is None:
+            output_file = F'app_segments_{self._tenant_id}_{time.strftime("%Y%m%d_%H%M%S")}.{output_format}'
+        snapshot_file = self.snapshot_file_name(snapshot_file)
+        previous_snapshot = {}
+        if changes_only and os.path.isfile(snapshot_file):
+            with open(snapshot_file, 'r') as snapshot_f:
+                previous_snapshot = json.load(snapshot_f)
+
+        self.authenticated_session()
+        snapshot = {}
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        with open(output_file, 'w', newline='') as export_file:
+            writer = EXPORT_WRITERS[output_format](export_file)
+            for app_seg in self.iter_paginated_list(endpoint_url=self._app_segments_endpoint):
+                seg_id = str(app_seg.get('id'))
+                seg_hash = app_segment_hash(app_seg)
+                snapshot[seg_id] = {'hash': seg_hash,
+                                    'name': app_seg.get('name'),
+                                    'segmentGroupName': app_seg.get('segmentGroupName')}
+                if not changes_only:
+                    writer.write(app_seg)
+                    continue
+                if seg_id not in previous_snapshot:
+                    change = 'added'
+                elif previous_snapshot[seg_id]['hash'] != seg_hash:
+                    change = 'changed'
+                else:
+                    counts['unchanged'] += 1
+                    continue
+                counts[change] += 1
+                writer.write(app_seg, change=change)
+            for seg_id in previous_snapshot.keys() - snapshot.keys():
+                removed = previous_snapshot[seg_id]
+                counts['removed'] += 1
+                writer.write({'id': seg_id, 'name': removed['name'], 'segmentGroupName': removed['segmentGroupName']},
+                             change='removed')
+
+        if update_snapshot:
+            # replace the snapshot only after a complete export so a failed run is diffed again on the next one
+            with open(snapshot_file + '.tmp', 'w') as snapshot_f:
+                json.dump(snapshot, snapshot_f)
+            os.replace(snapshot_file + '.tmp', snapshot_file)
+        if changes_only:
+            print(F"EXPORTED CHANGES TO {output_file}: {counts['added']} ADDED, {counts['changed']} CHANGED, "
+                  F"{counts['removed']} REMOVED, {counts['unchanged']} UNCHANGED")
+        else:
+            print(F'EXPORTED {len(snapshot)} APP SEGMENTS TO {output_file}')
+
+    def index_file_name(self, index_file=None):
+        if index_file is not None:
+            return index_file
+        if self._tenant_id is None:
+            print('ERROR: provide the tenant id (--ti) or the index file (--index_file)')
+            sys.exit(-1)
+        return F'app_segments_index_{self._tenant_id}.pickle'
+
+    def load_app_segment_index(self, index_file=None):
+        index_file = self.index_file_name(index_file)
+        if not os.path.isfile(index_file):
+            print(F'ERROR: INDEX FILE {index_file} DOES NOT EXIST, BUILD IT WITH build_app_segment_index')
+            sys.exit(-1)
+        try:
+            return AppSegmentIndex.load(index_file)
+        except (ValueError, pickle.UnpicklingError, EOFError) as exception:
+            print(F'ERROR: COULD NOT LOAD INDEX FILE {index_file}: {exception}')
+            sys.exit(-1)
+
+    @profiled_phase('index')
+    def build_app_segment_index(self, index_file=None):
+        index_file = self.index_file_name(index_file)
         self.authenticated_session()
         self.get_app_segments()
-        with open(F'app_domians_dump_{self._tenant_id}.txt', 'w') as dump_file:
-            for app_seg in self.app_segments:
-                dump_file.write(F"{app_seg['name']} ({app_seg['segmentGroupName']})")
-                dump_file.write('\n')
-                self.dump_port_ranges(app_seg, 'TCP', dump_file)
-                self.dump_port_ranges(app_seg, 'UDP', dump_file)
-                for domain in app_seg['domainNames']:
-                    dump_file.write(domain)
-                    dump_file.write('\n')
-
-    def dump_port_ranges(self, app_seg, proto, dump_file):
-        ports_key = None
-        if proto == 'UDP':
-            ports_key = 'udpPortRanges'
-        elif proto == 'TCP':
-            ports_key = 'tcpPortRanges'
-        if ports_key in app_seg:
-            port_ranges = self.port_ranges_str(app_seg[ports_key])
-            dump_file.write(F'{proto} PORT RANGES: {",".join(port_ranges)}')
-            dump_file.write('\n')
+        index = AppSegmentIndex(app_segments=self.app_segments)
+        index.save(index_file)
+        print(F'INDEXED {len(index.segments)} APP SEGMENTS INTO {index_file}')
+
+    @profiled_phase('index')
+    def lookup_app_segment(self, host, port=None, proto='TCP', index_file=None):
+        load_start = time.perf_counter()
+        index = self.load_app_segment_index(index_file)
+        lookup_start = time.perf_counter()
+        matches = index.lookup(host=str(host), port=port, proto=proto)
+        lookup_end = time.perf_counter()
+        if not matches:
+            print(F'NO APP SEGMENT COVERS {host}:{port} ({proto})')
+        for app_seg in matches:
+            print(F"{app_seg['name']} ({app_seg['segmentGroupName']}) ID: {app_seg['id']}")
+        print(F'INDEX LOADED IN {(lookup_start - load_start) * 1000:.2f} MS, '
+              F'LOOKUP TOOK {(lookup_end - lookup_start) * 1000000:.1f} US')
+
+    @profiled_phase('index')
+    def benchmark_app_segment_index(self, index_file=None, synthetic_segments=0, lookups=100000):
+        if synthetic_segments:
+            index = AppSegmentIndex(app_segments=APIManager.synthetic_app_segments(synthetic_segments))
+            index_file = index_file or F'app_segments_index_synthetic_{synthetic_segments}.pickle'
+            index.save(index_file)
+        load_start = time.perf_counter()
+        index = self.load_app_segment_index(index_file)
+        load_time = time.perf_counter() - load_start
+        print(F'SEGMENTS: {len(index.segments)}, INDEX LOAD: {load_time * 1000:.2f} MS')
+
+        rnd = random.Random(0)
+        # ports most segments share plus ports from the segments' own ranges, so most lookups hit
+        tcp_ranges = [(start, end) for starts, ends in index._port_ranges['TCP'] for start, end in zip(starts, ends)]
+        ports = [443, 80] + [rnd.randint(start, end) for start, end in rnd.sample(tcp_ranges, min(len(tcp_ranges), 1000))]
+        for host_kind, hosts in (('HOSTNAME', list(APIManager.index_hosts(index))),
+                                 ('IP', list(APIManager.index_addresses(index, rnd)))):
+            if not hosts:
+                continue
+            queries = [(rnd.choice(hosts), rnd.choice(ports) if rnd.random() < 0.5 else rnd.choice(ports[:2]))
+                       for _ in range(lookups)]
+            lookup_start = time.perf_counter()
+            hits = 0
+            for host, port in queries:
+                if index.lookup(host=host, port=port):
+                    hits = hits + 1
+            lookup_time = time.perf_counter() - lookup_start
+            print(F'{host_kind} LOOKUPS: {lookups}, HITS: {hits}, AVG LOOKUP: {lookup_time / lookups * 1000000:.2f} US')
+
+    @staticmethod
+    def index_hosts(index):
+        # concrete host names to query, wildcard entries get a made up first label
+        stack = [((), index._domain_trie)]
+        while stack:
+            labels, node = stack.pop()
+            if node['exact']:
+                yield '.'.join(reversed(labels))
+            if node['wildcard']:
+                yield '.'.join(('host',) + tuple(reversed(labels)))
+            for label, child in node['labels'].items():
+                stack.append((labels + (label,), child))
+
+    @staticmethod
+    def index_addresses(index, rnd):
+        # one random address inside every indexed network
+        for version, by_prefix in index._networks.items():
+            max_prefix = 32 if version == 4 else 128
+            for prefixlen, by_address in by_prefix.items():
+                for network_int in by_address:
+                    host_bits = rnd.getrandbits(max_prefix - prefixlen) if prefixlen < max_prefix else 0
+                    yield str(ipaddress.ip_address(network_int + host_bits))
+
+    @staticmethod
+    def synthetic_app_segments(count):
+        rnd = random.Random(count)
+        app_segments = []
+        for seg_no in range(count):
+            domain = F'app{seg_no}.dept{seg_no % 50}.example.com'
+            domain_names = [domain, F'*.{domain}']
+            # every tenth segment is a network segment: a /24 inside 10.0.0.0/8, which segment 0 covers as a whole,
+            # and every hundredth also a /16 of its own
+            if seg_no % 10 == 0:
+                domain_names = [F'10.{seg_no // 2560}.{(seg_no // 10) % 256}.0/24']
+                if seg_no % 100 == 0:
+                    domain_names.append(F'100.{seg_no // 100 % 256}.0.0/16')
+                if seg_no == 0:
+                    domain_names.append('10.0.0.0/8')
+            start_port = rnd.randint(1024, 60000)
+            tcp_ranges = [str(start_port), str(start_port + rnd.randint(0, 1000))]
+            # like in real tenants nearly every segment covers 443 and many cover 80
+            if rnd.random() < 0.9:
+                tcp_ranges = tcp_ranges + ['443', '443']
+            if rnd.random() < 0.5:
+                tcp_ranges = tcp_ranges + ['80', '80']
+            app_segments.append({'id': str(seg_no),
+                                 'name': F'segment_{seg_no}',
+                                 'segmentGroupName': F'group_{seg_no % 20}',
+                                 'domainNames': domain_names,
+                                 'tcpPortRanges': tcp_ranges,
+                                 'udpPortRanges': ['53', '53']})
+        return app_segments
 
     @property
     def app_segments(self):
@@ -87,6 +472,7 @@ class APIManager:
     def get_app_segments(self):
         self._app_segments_list = self.get_paginated_list(endpoint_url=self._app_segments_endpoint)
 
+    @profiled_phase('app_segment_paging')
     @sleep_and_retry
     @limits(calls=1, period=2)
     def get_data_list(self, data_url):
@@ -98,18 +484,20 @@ class APIManager:
         return object_list
 
     def get_paginated_list(self, endpoint_url):
-        data_list = []
+        return list(self.iter_paginated_list(endpoint_url=endpoint_url))
+
+    def iter_paginated_list(self, endpoint_url):
         page_no = 1
         while True:
             pagination = F'?page={page_no}&pageSize={self._page_size}'
             paginated_url = endpoint_url + pagination
             rep_data_obj = self.get_data_list(data_url=paginated_url)
-            data_list = data_list + rep_data_obj['list']
             print(F'GOT DATA PAGE {page_no} FROM URL {endpoint_url}')
+            for data_obj in rep_data_obj.get('list', []):
+                yield data_obj
             page_no = page_no + 1
-            if page_no > int(rep_data_obj['totalPages']):
+            if page_no > int(rep_data_obj.get('totalPages', 0)):
                 break
-        return data_list
 
 
 if __name__ == '__main__':
@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 import copy
 import csv
 import datetime
 import fire
+import fnmatch
 import json
 import os
-from ratelimit import limits, sleep_and_retry
+from profiling import profiled_phase, RunProfiler
+from ratelimit import limits, sleep_and_retry, RateLimitException
 import re
 import requests
 import sys
@@ -33,6 +36,18 @@ def chunks_of_len(list_to_chunk, chunk_len=400):
     return (list_to_chunk[i:i + n] for i in range(0, len(list_to_chunk), n))
 
 
+# same 400 limit as above, but fills chunks from a stream instead of a complete list
+def chunks_of_iter(iterable, chunk_len=400):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_len:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def chunks_n_eq(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
@@ -84,9 +99,14 @@ class DepartmentInterationStatus:
         self.current_department = departments_list[0]
 
 
+class UsersScanError(Exception):
+    pass
+
+
 class APIManager:
     SECONDS_IN_HOUR = 60 * 60
     THREE_MINUTES = 3 * 60
+    ONE_MINUTE = 60
 
     LOCATIONS_ENDPOINT = 'locations'
     LOCATIONS_ENDPOINT_URL = '/'.join([API_URL, LOCATIONS_ENDPOINT])
@@ -100,6 +120,7 @@ class APIManager:
     USERS_ENDPOINT = 'users'
     USERS_ENDPOINT_URL = '/'.join([API_URL, USERS_ENDPOINT])
     USER_PUT_ENDPOINT = '/'.join([API_URL, USERS_ENDPOINT, '{}'])
+    USERS_BULK_DELETE_ENDPOINT_URL = '/'.join([API_URL, USERS_ENDPOINT, 'bulkDelete'])
 
     DEPT_GROUP_PROGRESS_FILE = 'add_dept_group_progress'
 
@@ -109,8 +130,11 @@ class APIManager:
     DELETED_DEP = '{IDP:'
 
     MAX_RETRIES = 1000
+    DEFAULT_MAX_WORKERS = 8
+    BULK_DELETE_CHUNK_LEN = 400
 
-    def __init__(self, u, p, k):
+    def __init__(self, u, p, k, profile=False):
+        self._profiler = RunProfiler.from_option(run_name='zs_api', profile=profile)
         self._session = None
         self._locations_list = None
         self._locations_dict = None
@@ -133,6 +157,7 @@ class APIManager:
         return re.sub('[{}]', '', department_name)
 
     # move this to class aggregating managers
+    @profiled_phase('auth')
     def start_auth_session(self):
         self._session = requests.session()
         self._session.verify = False
@@ -146,6 +171,7 @@ class APIManager:
             print("Authentication failed, exiting!")
             sys.exit(-1)
 
+    @profiled_phase('reference_data')
     def get_departments(self):
         page_no = 1
         while True:
@@ -163,6 +189,7 @@ class APIManager:
             page_no = page_no + 1
         self._departments_dict = {d['name']: d for d in self._departments_list}
 
+    @profiled_phase('reference_data')
     def get_groups(self):
         page_no = 1
         while True:
@@ -228,6 +255,7 @@ class APIManager:
         self._validate_departments(input_department=input_department)
         self._validate_groups(input_groups=input_groups)
 
+    @profiled_phase('updates')
     def get_and_modify_users_from_api(self, input_department, groups, start, end):
         page_number = start
         group_index = 0
@@ -241,7 +269,7 @@ class APIManager:
             group_to_add_name = groups[group_index]
             users_data = self.get_users_page_to_modify(input_department=input_department,
                                                        page_number=page_number)
-            if len(users_data) == 0:
+            if not users_data:
                 break
             for user in users_data:
                 try:
@@ -364,13 +392,14 @@ class APIManager:
                 return True
         return False
 
+    @profiled_phase('updates')
     def add_department_group(self, start_page, group_to_add, input_department):
         page_number = start_page
         while True:
             group_to_add_name = group_to_add['name']
             users_data = self.get_users_page_to_modify(input_department=input_department,
                                                        page_number=page_number)
-            if len(users_data) == 0:
+            if not users_data:
                 break
             user_idx = 0
             while True:
@@ -398,6 +427,7 @@ class APIManager:
             page_number += 1
             self.save_page_progress(input_department, page_number)
 
+    @profiled_phase('updates')
     def get_and_modify_user_name_from_api(self, start, end):
         page_number = start
         while True:
@@ -405,7 +435,7 @@ class APIManager:
                 break
             # five 500 long user pages per group -> 2.5k users per group
             users_data = self.get_users_page_to_modify(page_number=page_number)
-            if len(users_data) == 0:
+            if not users_data:
                 break
             for user in users_data:
                 try:
@@ -415,6 +445,7 @@ class APIManager:
                     continue
             page_number += 1
 
+    @profiled_phase('updates')
     @sleep_and_retry
     @limits(calls=50, period=THREE_MINUTES)
     def update_user_data(self, user_obj):
@@ -442,6 +473,7 @@ class APIManager:
             print('USER {} ALREADY IN GROUP: {}'.format(user_obj['name'], str(group_to_add)))
             return False
 
+    @profiled_phase('updates')
     @sleep_and_retry
     @limits(calls=50, period=THREE_MINUTES)
     def update_user_name(self, user_obj):
@@ -454,20 +486,38 @@ class APIManager:
         else:
             print('USER NAME {} NOT UPDATED'.format(user_obj['name']))
 
+    @profiled_phase('user_paging')
     @sleep_and_retry
     @limits(calls=1, period=6)
-    def get_users_page_to_modify(self, input_department=None, page_number=1):
+    def get_users_page_to_modify(self, input_department=None, page_number=1, input_group=None):
         pagination = 'page={page_no}&pageSize={page_size}'.format(page_no=page_number, page_size=self._page_size)
+        filters = []
         if input_department is not None:
+            filters.append('dept=' + quote(input_department))
+        if input_group is not None:
+            filters.append('group=' + quote(input_group))
+        if filters:
             paginated_url = '/'.join(
-                [API_URL, self.USERS_ENDPOINT, '?dept=' + quote(input_department) + '&' + pagination])
+                [API_URL, self.USERS_ENDPOINT, '?' + '&'.join(filters) + '&' + pagination])
         else:
             paginated_url = '/'.join([API_URL, self.USERS_ENDPOINT + '?' + pagination])
-        get_users_result = self._session.get(url=paginated_url, headers=HEADERS)
+        try:
+            get_users_result = self._session.get(url=paginated_url, headers=HEADERS)
+        except requests.RequestException as exception:
+            print(F'EXCEPTION {exception} AT GET USERS PAGE')
+            return None
+        if get_users_result.status_code == 429:
+            period_remaining = APIManager.retry_after_seconds(get_users_result)
+            print(F'GET USERS PAGE QUOTA EXCEEDED, RETRYING IN {period_remaining} SECONDS')
+            raise RateLimitException('users quota exceeded', period_remaining)
         if get_users_result.status_code != 200:
-            print(F'ERROR AT GET USERS PAGE: {get_users_result.status_code}')
-        users = json.loads(get_users_result.content.decode('utf-8'))
-        return users
+            print(F'ERROR AT GET USERS PAGE: {get_users_result.status_code}, content: {get_users_result.content}')
+            return None
+        try:
+            return json.loads(get_users_result.content.decode('utf-8'))
+        except ValueError:
+            print(F'GET USERS PAGE RESPONSE IS NOT JSON: {get_users_result.content}')
+            return None
 
     def add_test_user(self):
         user_to_upload = self._test_users_to_upload.get_next()
@@ -543,32 +593,239 @@ class APIManager:
         with open(bulk_users_file_path, 'r') as users_f:
             self._test_users_to_upload = TestUserUpload(users_to_upload=json.load(users_f))
 
-    @sleep_and_retry
-    @limits(calls=10, period=SECONDS_IN_HOUR)
     def remove_users(self, users_id_list):
-        users_blk_del_endpoint = 'users/bulkDelete'
-        endpoint_url = '/'.join([API_URL, users_blk_del_endpoint])
-        for chunk in chunks_of_len(users_id_list):
-            blk_del_result = self._session.post(url=endpoint_url,
-                                                json={
-                                                    'ids': chunk
-                                                },
-                                                headers=HEADERS)
-            print('BULK DELETE USERS RESULT: {}'.format(blk_del_result.status_code))
-        time.sleep(61)
+        return self.delete_user_ids(user_ids=users_id_list)
+
+    def bulk_delete_users(self, department=None, group=None, name_pattern=None, ids_file=None, dry_run=False):
+        if department is None and group is None and name_pattern is None and ids_file is None:
+            print('ERROR: provide department, group, name_pattern or ids_file to select users to delete')
+            sys.exit(1)
+        if ids_file is not None and (department is not None or group is not None or name_pattern is not None):
+            print('ERROR: ids_file can not be combined with department, group or name_pattern')
+            sys.exit(1)
+        self.start_auth_session()
+        if department is not None:
+            self.get_departments()
+            self._validate_departments(input_department=department)
+        if group is not None:
+            self._validate_groups(input_groups=[group])
+
+        if ids_file is not None:
+            user_ids = self.load_user_ids(ids_file=ids_file)
+            rescan = None
+        else:
+            def rescan():
+                return self.iter_user_ids(department=department, group=group, name_pattern=name_pattern)
+            user_ids = rescan()
+        if dry_run:
+            try:
+                ids_to_delete = list(user_ids)
+            except UsersScanError as exception:
+                print(F'USER SCAN FAILED: {exception}, EXITING')
+                sys.exit(-1)
+            print(F'DRY RUN, WOULD DELETE {len(ids_to_delete)} USERS: {ids_to_delete}')
+            return
+        self.delete_user_ids(user_ids=user_ids, rescan=rescan)
+
+    def iter_users(self, department=None, group=None):
+        page_number = 1
+        while True:
+            users_data = self.get_users_page_to_modify(input_department=department,
+                                                       input_group=group,
+                                                       page_number=page_number)
+            if users_data is None or not isinstance(users_data, list):
+                raise UsersScanError(F'could not get users page {page_number}')
+            if len(users_data) == 0:
+                break
+            print(F'GOT USERS PAGE {page_number}')
+            for user in users_data:
+                yield user
+            page_number += 1
+
+    def iter_user_ids(self, department=None, group=None, name_pattern=None):
+        name_regex = re.compile(name_pattern) if name_pattern is not None else None
+        for user in self.iter_users(department=department, group=group):
+            # dept and group query filters match partially, Sales also returns users of Sales Ops
+            if department is not None and (user.get('department') or {}).get('name') != department:
+                continue
+            if group is not None and not any(user_group.get('name') == group for user_group in user.get('groups') or []):
+                continue
+            if name_regex is not None:
+                if not name_regex.search(user.get('name') or '') and not name_regex.search(user.get('email') or ''):
+                    continue
+            yield user['id']
+
+    @staticmethod
+    def load_user_ids(ids_file):
+        with open(ids_file, 'r') as ids_f:
+            reader = csv.reader(ids_f)
+            for row in reader:
+                if len(row) > 0 and row[0].strip().isdigit():
+                    yield int(row[0].strip())
+
+    @profiled_phase('updates')
+    def delete_user_ids(self, user_ids, rescan=None):
+        # chunks are handed to a single worker as soon as they fill, so paging continues while the worker
+        # waits for the bulkDelete quota; the worker is the only caller so the quota is never exceeded
+        submitted_ids = set()
+        not_deleted_ids = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                pending_at_start = [future for future in futures if not future.done()]
+                new_ids = (user_id for user_id in user_ids if user_id not in submitted_ids)
+                submitted_count = 0
+                try:
+                    for chunk in chunks_of_iter(new_ids, chunk_len=APIManager.BULK_DELETE_CHUNK_LEN):
+                        submitted_ids.update(chunk)
+                        submitted_count += len(chunk)
+                        futures.append(executor.submit(self.delete_users_chunk, chunk))
+                        print(F'QUEUED BULK DELETE CHUNK OF {len(chunk)} USERS, {len(submitted_ids)} QUEUED IN TOTAL')
+                except UsersScanError as exception:
+                    # IDs of the partially filled chunk were never queued, finish and report what was
+                    print(F'USER SCAN FAILED: {exception}, STOPPING AFTER QUEUED CHUNKS')
+                    break
+                if rescan is None:
+                    break
+                # deleting users while paging shifts later pages, keep sweeping until a pass started
+                # with no deletes in flight finds nothing new
+                if submitted_count == 0 and len(pending_at_start) == 0:
+                    break
+                if submitted_count == 0:
+                    wait(futures)
+                user_ids = rescan()
+            for future in futures:
+                not_deleted_ids.extend(future.result())
+        print(F'BULK DELETE FINISHED, DELETED {len(submitted_ids) - len(not_deleted_ids)} OF {len(submitted_ids)} USERS')
+        if not_deleted_ids:
+            print(F'USERS NOT DELETED: {not_deleted_ids}')
+        return not_deleted_ids
+
+    def delete_users_chunk(self, ids_chunk):
+        try:
+            blk_del_result = self.post_bulk_delete(ids_chunk=ids_chunk)
+            return APIManager.confirm_bulk_delete(ids_chunk=ids_chunk, blk_del_result=blk_del_result)
+        except Exception as exception:
+            print(F'EXCEPTION {exception} ON BULK DELETE ATTEMPT')
+            return list(ids_chunk)
+
+    @profiled_phase('updates')
+    @sleep_and_retry
+    @limits(calls=1, period=ONE_MINUTE)
+    def post_bulk_delete(self, ids_chunk):
+        blk_del_result = self._session.post(url=self.USERS_BULK_DELETE_ENDPOINT_URL,
+                                            json={
+                                                'ids': ids_chunk
+                                            },
+                                            headers=HEADERS)
+        if blk_del_result.status_code == 429:
+            period_remaining = APIManager.retry_after_seconds(blk_del_result)
+            print(F'BULK DELETE QUOTA EXCEEDED, RETRYING IN {period_remaining} SECONDS')
+            raise RateLimitException('bulkDelete quota exceeded', period_remaining)
+        return blk_del_result
+
+    @staticmethod
+    def retry_after_seconds(result):
+        retry_after = re.match(r'\d+', result.headers.get('Retry-After', ''))
+        return int(retry_after.group()) if retry_after else APIManager.ONE_MINUTE
+
+    @staticmethod
+    def confirm_bulk_delete(ids_chunk, blk_del_result):
+        print('BULK DELETE USERS RESULT: {}'.format(blk_del_result.status_code))
+        if blk_del_result.status_code not in (200, 204):
+            print(F'BULK DELETE OF {len(ids_chunk)} USERS FAILED: {blk_del_result.content}')
+            return list(ids_chunk)
+        if not blk_del_result.content:
+            return []
+        try:
+            deleted = json.loads(blk_del_result.content.decode('utf-8'))
+        except ValueError:
+            print(F'BULK DELETE RESPONSE IS NOT JSON, {len(ids_chunk)} USERS NOT CONFIRMED: {blk_del_result.content}')
+            return list(ids_chunk)
+        if not isinstance(deleted, dict) or not isinstance(deleted.get('ids'), list):
+            print(F'UNEXPECTED BULK DELETE RESPONSE, {len(ids_chunk)} USERS NOT CONFIRMED: {deleted}')
+            return list(ids_chunk)
+        not_deleted_ids = sorted(set(ids_chunk).difference(deleted['ids']))
+        if not_deleted_ids:
+            print(F'BULK DELETE DID NOT CONFIRM {len(not_deleted_ids)} OF {len(ids_chunk)} USERS')
+        return not_deleted_ids
 
     def enable_ips_on_locations(self):
         self.start_auth_session()
-        for location in self.locations:
-            print(location)
-            if 'ipsControl' not in location or not location['ipsControl']:
-                location['ipsControl'] = True
-                update_result = self.update_location(location)
+        self.apply_desired_location_state(desired_state={'locations': {'*': {'ipsControl': True}}})
+
+    def reconcile_locations(self, desired_state_file, dry_run=False, max_workers=DEFAULT_MAX_WORKERS):
+        with open(desired_state_file, 'r') as desired_state_f:
+            desired_state = json.load(desired_state_f)
+        self.start_auth_session()
+        self.apply_desired_location_state(desired_state=desired_state, dry_run=dry_run, max_workers=max_workers)
+
+    @profiled_phase('updates')
+    def apply_desired_location_state(self, desired_state, dry_run=False, max_workers=DEFAULT_MAX_WORKERS):
+        location_patterns = desired_state.get('locations', {})
+        sublocation_patterns = desired_state.get('sublocations', {})
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if sublocation_patterns:
+                # the rate limit on get_sublocations is shared between the workers, they only overlap the round trips
+                fetched_sublocations = executor.map(self.get_sublocations, self.locations)
+                failed_locations = [location['name'] for location, sublocations
+                                    in zip(self.locations, fetched_sublocations) if sublocations is None]
+                if failed_locations:
+                    print(F'SUBLOCATIONS OF {len(failed_locations)} LOCATIONS COULD NOT BE FETCHED AND WILL NOT '
+                          F'BE RECONCILED: {failed_locations}')
+
+            locations_to_update = []
+            for location in self.locations:
+                settings = APIManager.desired_settings(name=location['name'], patterns=location_patterns)
+                locations_to_update.extend(APIManager.location_update(location=location, settings=settings))
+                for sublocation in self._sublocations_map.get(location['id'], []):
+                    subloc_path = '/'.join([location['name'], sublocation['name']])
+                    settings = APIManager.desired_settings(name=subloc_path, patterns=sublocation_patterns)
+                    locations_to_update.extend(APIManager.location_update(location=sublocation, settings=settings,
+                                                                          display_name=subloc_path))
+
+            print(F'{len(locations_to_update)} LOCATIONS AND SUBLOCATIONS DIFFER FROM DESIRED STATE')
+            if dry_run or len(locations_to_update) == 0:
+                return
+            updated_locations = [updated for _, updated in locations_to_update]
+            for (display_name, _), update_result in zip(locations_to_update,
+                                                        executor.map(self.update_location, updated_locations)):
                 if update_result.status_code == 200:
-                    print(F'SUCCESSFULLY UPDATED {location["name"]} to use IPS')
+                    print(F'SUCCESSFULLY UPDATED {display_name}')
                 else:
-                    print(F'FAILED TO UPDATE {location["name"]} with IPS, result code: {update_result.status_code}')
+                    print(F'FAILED TO UPDATE {display_name}, result code: {update_result.status_code}, '
+                          F'content: {update_result.content}')
+
+    @staticmethod
+    def desired_settings(name, patterns):
+        # patterns are applied in file order, settings of later matching patterns override earlier ones
+        settings = {}
+        for pattern, pattern_settings in patterns.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                settings.update(pattern_settings)
+        return settings
 
+    @staticmethod
+    def location_update(location, settings, display_name=None):
+        if display_name is None:
+            display_name = location['name']
+        diff = {}
+        for key, value in settings.items():
+            current = location.get(key)
+            # the API omits boolean flags that are switched off
+            if isinstance(value, bool):
+                current = bool(current)
+            if current != value:
+                diff[key] = value
+        if not diff:
+            return []
+        print(F'{display_name} DIFFERS: ' + ', '.join(F'{key}: {location.get(key)} -> {value}'
+                                                      for key, value in diff.items()))
+        updated_location = copy.deepcopy(location)
+        updated_location.update(diff)
+        return [(display_name, updated_location)]
+
+    @profiled_phase('updates')
     @sleep_and_retry
     @limits(calls=50, period=THREE_MINUTES)
     def update_location(self, location):
@@ -584,12 +841,16 @@ class APIManager:
         source_loc_obj = self._location_by_name(source_loc)
         target_loc_obj = self._location_by_name(target_loc)
         source_sublocs = self.get_sublocations(source_loc_obj)
+        if source_sublocs is None:
+            print(F'COULD NOT GET SUBLOCATIONS OF {source_loc}. EXITING')
+            sys.exit(-1)
         for loc_to_clone in source_sublocs:
             if loc_to_clone['name'] == 'other':
                 continue
             loc_to_clone['parentId'] = target_loc_obj['id']
             self.create_location(loc_to_clone)
 
+    @profiled_phase('updates')
     @sleep_and_retry
     @limits(calls=50, period=THREE_MINUTES)
     def create_location(self, loc_to_create):
@@ -609,29 +870,61 @@ class APIManager:
             print(F'LOCATION {target_loc} DOES NOT EXIST. EXITING')
             sys.exit(-1)
 
+    @profiled_phase('reference_data')
     @sleep_and_retry
     @limits(calls=1, period=1)
     def get_sublocations(self, location_obj):
         subloc_url = self.SUBLOCATIONS_ENDPOINT_URL.format(location_obj['id'])
-        get_groups_results = self._session.get(url=subloc_url,
-                                               headers=HEADERS)
-        if get_groups_results.status_code != 200:
-            print(F'ERROR AT GET USERS PAGE: {get_groups_results.status_code}')
-        sublocs_obj = json.loads(get_groups_results.content.decode('utf-8'))
+        try:
+            get_sublocs_results = self._session.get(url=subloc_url,
+                                                    headers=HEADERS)
+        except requests.RequestException as exception:
+            print(F'EXCEPTION {exception} AT GET SUBLOCATIONS OF {location_obj["name"]}')
+            return None
+        if get_sublocs_results.status_code == 429:
+            period_remaining = APIManager.retry_after_seconds(get_sublocs_results)
+            print(F'GET SUBLOCATIONS QUOTA EXCEEDED, RETRYING IN {period_remaining} SECONDS')
+            raise RateLimitException('sublocations quota exceeded', period_remaining)
+        if get_sublocs_results.status_code != 200:
+            print(F'ERROR AT GET SUBLOCATIONS OF {location_obj["name"]}: {get_sublocs_results.status_code}, '
+                  F'content: {get_sublocs_results.content}')
+            return None
+        try:
+            sublocs_obj = json.loads(get_sublocs_results.content.decode('utf-8'))
+        except ValueError:
+            print(F'SUBLOCATIONS OF {location_obj["name"]} ARE NOT JSON: {get_sublocs_results.content}')
+            return None
+        if not isinstance(sublocs_obj, list):
+            print(F'UNEXPECTED SUBLOCATIONS OF {location_obj["name"]}: {sublocs_obj}')
+            return None
         self._sublocations_map[location_obj['id']] = sublocs_obj
         # self._locations_dict = {g['name']: g for g in self._locations_list}
         return self._sublocations_map[location_obj['id']]
 
-    @sleep_and_retry
-    @limits(calls=1, period=1)
+    @profiled_phase('reference_data')
     def get_locations(self):
-        get_groups_results = self._session.get(url=self.LOCATIONS_ENDPOINT_URL,
-                                               headers=HEADERS)
-        if get_groups_results.status_code != 200:
-            print(F'ERROR AT GET USERS PAGE: {get_groups_results.status_code}')
-        self._locations_list = json.loads(get_groups_results.content.decode('utf-8'))
+        self._locations_list = []
+        page_no = 1
+        while True:
+            locations_page = self.get_locations_page(page_no=page_no)
+            if len(locations_page) == 0:
+                break
+            self._locations_list = self._locations_list + locations_page
+            print(F'GOT LOCATIONS PAGE {page_no}')
+            page_no = page_no + 1
         self._locations_dict = {g['name']: g for g in self._locations_list}
 
+    @sleep_and_retry
+    @limits(calls=1, period=1)
+    def get_locations_page(self, page_no):
+        pagination = F'page={page_no}&pageSize={self._page_size}'
+        get_locations_results = self._session.get(url=self.LOCATIONS_ENDPOINT_URL + '?' + pagination,
+                                                  headers=HEADERS)
+        if get_locations_results.status_code != 200:
+            print(F'ERROR AT GET LOCATIONS PAGE: {get_locations_results.status_code}')
+            sys.exit(-1)
+        return json.loads(get_locations_results.content.decode('utf-8'))
+
     def check_source_and_target_loc(self, source_loc, target_loc):
         pass
 